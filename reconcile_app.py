@@ -1,81 +1,125 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
 import re
-import pdfplumber
 import sys
 import os
+import threading
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import zip_longest
 from openpyxl import load_workbook, Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import PatternFill, Font
 from io import BytesIO
 from dateutil.parser import parse as du_parse
 from datetime import datetime
 
+try:
+    import python_calamine  # Rust .xlsx reader behind pandas' "calamine" engine
+except ImportError:
+    python_calamine = None
+
 # --- CONFIG & STYLES ---
 st.set_page_config(page_title="Hotel Reconcile Pro (v1.15 Web)", page_icon="🏨", layout="wide")
 
 RED_FILL = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
 GREEN_FILL = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")
 
-MONTH_ABBR = {1:"Jan",2:"Feb",3:"Mar",4:"Apr",5:"May",6:"Jun",7:"Jul",8:"Aug",9:"Sep",10:"Oct",11:"Nov",12:"Dec"}
+MONTH_ABBR = ("", "Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov","Dec") # indexed by month number
 MONTH_MAP  = {"jan":1,"feb":2,"mar":3,"apr":4,"may":5,"jun":6,"jul":7,"aug":8,"sep":9,"oct":10,"nov":11,"dec":12}
 
+# Name keywords in priority order: when several appear, the earliest entry wins (v1.15 cascade order).
+# Hotel phrases are plain substrings; the short codes must stand alone as words.
+HOTEL_PHRASES = [("katathani","KT"), ("the shore","TS"), ("waters","WAT"), ("little shore","TLKL"),
+                 ("sands","SAN"), ("leaf on the sands","LFS"), ("leaf oceanside","LFO")]
+HOTEL_CODES   = ["KT","TS","WAT","TLKL","SAN","LFS","LFO"]
+OTA_KEYWORDS  = [("booking","Booking.com"), ("expedia","Expedia"), ("hotels.com","Expedia"), ("agoda","Agoda"),
+                 ("traveloka","Traveloka"), ("trip.com","Trip.com"), ("ctrip","Trip.com")]
+
+# --- PRECOMPILED PATTERNS ---
+# Compiled once at import; hot paths call the bound methods instead of re.* with literals.
+
+_KEY_DEL_TABLE = str.maketrans("", "", " -") # reservation keys drop spaces and hyphens
+_ALNUM_RE    = re.compile(r"[^a-z0-9]+")
+# Period in file names: "jan'25", "january 2025", "2025-01", "01-2025"
+_PERIOD_RE1  = re.compile(r"\b(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)\s*'(\d{2})\b")
+_PERIOD_RE2  = re.compile(r"\b(jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:t|tember)?|oct(?:ober)?|nov(?:ember)?)\D{0,3}(20\d{2})\b")
+_PERIOD_RE3  = re.compile(r"\b(20\d{2})[ _./-](0[1-9]|1[0-2])\b")
+_PERIOD_RE4  = re.compile(r"\b(0[1-9]|1[0-2])[ _./-](20\d{2})\b")
+# Characters Excel does not allow in sheet titles
+_SHEET_BAD_RE = re.compile(r"[\\/*?:\[\]]")
+# Expedia PDF (Hunter Mode)
+_WS_RE       = re.compile(r"\s+")
+_CLEAN_TABLE = str.maketrans({"\n": " ", '"': " ", ",": None})
+# Two-pass Hunter: find each booking-type anchor, then look for ID + date only within
+# HUNTER_WINDOW chars after it (a single unbounded ".*?" regex backtracks across the whole text).
+_HUNTER_ANCHOR_RE  = re.compile(r"(Expedia Collect|Hotel Collect)\s", re.IGNORECASE)
+_HUNTER_ID_DATE_RE = re.compile(r"(\d{8,15})\s.*?(\d{1,2}-[A-Za-z]{3}-\d{4})")
+_PRICE_RE    = re.compile(r"(\d+\.\d{2})")
+HUNTER_WINDOW = 400
+
+def _keyword_re(fragments):
+    # Zero-width lookahead alternation: one finditer pass reports every (even overlapping) hit
+    return re.compile("(?=(" + "|".join(fragments) + "))")
+
+# keyword text -> (priority, code)
+_HOTEL_HITS = {kw: (i, code) for i, (kw, code) in enumerate(
+    HOTEL_PHRASES + [(c.lower(), c) for c in HOTEL_CODES])}
+_HOTEL_RE   = _keyword_re([re.escape(kw) for kw, _ in HOTEL_PHRASES] +
+                          [rf"\b{c.lower()}\b" for c in HOTEL_CODES])
+_OTA_HITS   = {kw: (i, ota) for i, (kw, ota) in enumerate(OTA_KEYWORDS)}
+_OTA_RE     = _keyword_re([re.escape(kw) for kw, _ in OTA_KEYWORDS])
+
 # --- ORIGINAL HELPERS (From v1.15) ---
 
 def norm_key(v):
     s = "" if v is None else str(v)
-    s = s.strip().upper()
-    s = re.sub(r"[ \-]+", "", s)
-    return s
+    return s.strip().upper().translate(_KEY_DEL_TABLE)
+
+def norm_keys(values):
+    # Same as norm_key, applied to a whole column with pandas string ops
+    s = pd.Series(values, dtype=object)
+    s = s.where(s.notna(), "").astype(str).str.strip().str.upper()
+    return s.str.translate(_KEY_DEL_TABLE).tolist()
 
+# Filename classifiers are pure and see the same names repeatedly (matching loop + every job)
+@lru_cache(maxsize=512)
 def infer_hotel(text: str) -> str:
     t = (text or "").lower()
-    norm = re.sub(r"[^a-z0-9]+", " ", t).strip()
-    pad  = f" {norm} "
-    if "katathani" in norm: return "KT"
-    if "the shore" in norm: return "TS"
-    if "the waters" in norm or "waters" in norm: return "WAT"
-    if "the little shore" in norm or "little shore" in norm: return "TLKL"
-    if "the sands" in norm or "sands" in norm: return "SAN"
-    if "the leaf on the sands" in norm or "leaf on the sands" in norm: return "LFS"
-    if "the leaf oceanside" in norm or "leaf oceanside" in norm: return "LFO"
-    if " kt "   in pad: return "KT"
-    if " ts "   in pad: return "TS"
-    if " wat "  in pad: return "WAT"
-    if " tlkl " in pad: return "TLKL"
-    if " san "  in pad: return "SAN"
-    if " lfs "  in pad: return "LFS"
-    if " lfo "  in pad: return "LFO"
-    return "UNK"
+    norm = _ALNUM_RE.sub(" ", t).strip()
+    hits = [_HOTEL_HITS[m.group(1)] for m in _HOTEL_RE.finditer(norm)]
+    return min(hits)[1] if hits else "UNK"
 
+@lru_cache(maxsize=512)
 def infer_ota(text):
     t = (text or "").lower()
-    if "booking" in t: return "Booking.com"
-    if "expedia" in t or "hotels.com" in t: return "Expedia"
-    if "agoda" in t: return "Agoda"
-    if "traveloka" in t: return "Traveloka"
-    if "trip.com" in t or "ctrip" in t: return "Trip.com"
-    return "OTA"
+    hits = [_OTA_HITS[m.group(1)] for m in _OTA_RE.finditer(t)]
+    return min(hits)[1] if hits else "OTA"
 
 def canon_ota(name):
     n = (name or "").lower()
-    n = re.sub(r"[^a-z0-9]", "", n)
-    if any(x in n for x in ["bookingcom","booking"]): return "Booking.com"
-    if any(x in n for x in ["expedia","hotelscom","hotels"]): return "Expedia"
+    n = _ALNUM_RE.sub("", n)
+    if "booking" in n: return "Booking.com" # also covers "bookingcom"
+    if "expedia" in n or "hotels" in n: return "Expedia" # "hotels" also covers "hotelscom"
     return n
 
 def monyy(y:int, m:int): 
-    return f"{MONTH_ABBR.get(m,'Mon')}'{str(y)[-2:]}"
+    return f"{MONTH_ABBR[m]}'{y % 100:02d}"
 
+@lru_cache(maxsize=512)
 def extract_period_from_name(name):
     if not name: return None
     n = name.lower()
-    m = re.search(r"\b(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)\s*'(\d{2})\b", n)
+    m = _PERIOD_RE1.search(n)
     if m: return monyy(int("20"+m.group(2)), MONTH_MAP[m.group(1)])
-    m = re.search(r"\b(jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:t|tember)?|oct(?:ober)?|nov(?:ember)?)\D{0,3}(20\d{2})\b", n)
+    m = _PERIOD_RE2.search(n)
     if m: return monyy(int(m.group(2)), MONTH_MAP[m.group(1)[:3]])
-    m = re.search(r"\b(20\d{2})[ _./-](0[1-9]|1[0-2])\b", n)
+    m = _PERIOD_RE3.search(n)
     if m: return monyy(int(m.group(1)), int(m.group(2)))
-    m = re.search(r"\b(0[1-9]|1[0-2])[ _./-](20\d{2})\b", n)
+    m = _PERIOD_RE4.search(n)
     if m: return monyy(int(m.group(2)), int(m.group(1)))
     return None
 
@@ -87,85 +131,142 @@ def choose_period(hot_name, com_name, hot_earliest=None, com_earliest=None):
     return p
 
 def trim_sheet(n):
-    n = re.sub(r'[\\/*?:\\[\\]]', "_", n)
+    n = _SHEET_BAD_RE.sub("_", n)
     return n[:31]
 
-def find_header_col(ws, header_names, header_row=2):
-    names = set(h.lower() for h in header_names)
-    for c in range(1, ws.max_column+1):
-        v = ws.cell(row=header_row, column=c).value
-        s = "" if v is None else str(v).strip().lower()
-        if s in names: return c
-    return None
-
-def format_dates(ws, cols, start_row, end_row):
-    for col in cols:
-        if col is None: continue
-        for r in range(start_row, end_row+1):
-            ws.cell(row=r, column=col).number_format = "yyyy-mm-dd"
+def active_sheet_name(xlsx_bytes):
+    # Title of the active tab (the sheet openpyxl's wb.active returns), read from the workbook part
+    # only, so picking the sheet does not parse any cell data
+    with zipfile.ZipFile(BytesIO(xlsx_bytes)) as zf:
+        rels = ET.fromstring(zf.read("_rels/.rels"))
+        part = next((r.get("Target") for r in rels if r.get("Type", "").endswith("/officeDocument")),
+                    "xl/workbook.xml")
+        book = ET.fromstring(zf.read(part.lstrip("/")))
+    view = book.find("{*}bookViews/{*}workbookView")
+    sheets = book.findall("{*}sheets/{*}sheet")
+    idx = int(view.get("activeTab", 0)) if view is not None else 0
+    return sheets[min(idx, len(sheets)-1)].get("name")
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def read_sheet_rows(xlsx_bytes):
+    # Bulk-read the active sheet via calamine (Rust) instead of walking openpyxl cells.
+    # Row r / column c of the sheet is rows[r-1][c-1]; blank cells are None.
+    # Cached on the file bytes, so a Hoteliers file shared by several OTA files is parsed once
+    # (in memory; least recently used entries are evicted past max_entries).
+    if python_calamine is None:
+        # Fallback: openpyxl's streaming read-only mode (no styles, no per-cell objects kept)
+        wb = load_workbook(BytesIO(xlsx_bytes), read_only=True, data_only=True)
+        try:
+            ws = wb.active
+            ws.reset_dimensions() # don't trust the stored <dimension>: exporters often write a wrong one
+            rows = [list(r) for r in ws.iter_rows(values_only=True)]
+        finally:
+            wb.close()
+        width = max((len(r) for r in rows), default=0)
+        return [r + [None] * (width - len(r)) for r in rows]
+    # Only truly empty cells become None: text such as "N/A" or "NULL" is kept as-is, like openpyxl does
+    df = pd.read_excel(BytesIO(xlsx_bytes), engine="calamine", sheet_name=active_sheet_name(xlsx_bytes),
+                       header=None, dtype=object, keep_default_na=False, na_values=[""])
+    return df.astype(object).where(df.notna(), None).values.tolist()
+
+def build_header_index(header):
+    # Normalized header text -> first column carrying it (header row values, 1-based columns)
+    idx = {}
+    for c, v in enumerate(header, start=1):
+        idx.setdefault("" if v is None else str(v).strip().lower(), c)
+    return idx
+
+def find_header_col(idx, header_names):
+    # Leftmost column matching any of the names
+    return min((idx[h.lower()] for h in header_names if h.lower() in idx), default=None)
+
+def parse_dates(values, parsed):
+    # Cell values -> datetime or None. Real dates pass through; text goes through dateutil (fuzzy),
+    # memoized in `parsed` since exports repeat the same few date strings on many rows.
+    # Callers pass a dict scoped to one scan: fuzzy parsing fills missing fields ("15 Jan") from
+    # today's date, so results must not outlive the run that computed them.
+    out = []
+    for v in values:
+        if isinstance(v, datetime): out.append(v)
+        elif v in (None, ""): out.append(None)
+        else:
+            s = str(v)
+            if s not in parsed:
+                try: parsed[s] = du_parse(s, fuzzy=True)
+                except Exception: parsed[s] = None
+            out.append(parsed[s])
+    return out
+
+def styled_cell(ws, value, fill=None, font=None):
+    cell = WriteOnlyCell(ws, value=value)
+    if fill: cell.fill = fill
+    if font: cell.font = font
+    return cell
+
+def styled_row(ws, values, fill=None, date_cols=()):
+    # Cells carry their fill / date format from creation, so the row is finished as it is appended
+    # (the output workbook is write-only). Date columns are formatted per cell: openpyxl gives every
+    # datetime cell its own number format, which a column-level style would not override.
+    cells = []
+    for c, v in enumerate(values, start=1):
+        cell = styled_cell(ws, v, fill)
+        if c in date_cols: cell.number_format = "yyyy-mm-dd"
+        cells.append(cell)
+    return cells
 
 # --- CORE LOGIC: Hoteliers Processing ---
 
-def collect_hoteliers(ws):
-    header_row = 2
-    res_col = find_header_col(ws, ["Reservation number","Reservation id","Confirmation number"], header_row) or 2
-    arr_col = find_header_col(ws, ["Arrival","Check-in","Check in"], header_row)
-    dep_col = find_header_col(ws, ["Departure","Check-out","Check out"], header_row)
-    ota_col = find_header_col(ws, [
+def collect_hoteliers(rows):
+    header = build_header_index(rows[1] if len(rows) > 1 else [])
+    res_col = find_header_col(header, ["Reservation number","Reservation id","Confirmation number"]) or 2
+    arr_col = find_header_col(header, ["Arrival","Check-in","Check in"])
+    dep_col = find_header_col(header, ["Departure","Check-out","Check out"])
+    ota_col = find_header_col(header, [
         "Channel","OTA","Booking Channel","Source","Distributor","Partner","Agency","Agent",
         "Merchant","Reservation Source","Booking Site","Website","Booking Source"
-    ], header_row)
+    ])
 
-    last_nonempty = ws.max_row
+    last_nonempty = len(rows)
     while last_nonempty > 1:
-        if any(ws.cell(row=last_nonempty, column=c).value not in (None, "") for c in range(1, ws.max_column+1)):
+        if any(v not in (None, "") for v in rows[last_nonempty-1]):
             break
         last_nonempty -= 1
     data_start = 3
     data_end = max(2, last_nonempty - 1)
 
-    keys_by_period, rows_by_period = {}, {}
-    earliest_dep = None
-
-    for r in range(data_start, data_end+1):
-        d = ws.cell(row=r, column=dep_col).value if dep_col else None
-        dt = d if isinstance(d, datetime) else None
-        if not dt and d not in (None, ""):
-            try: dt = du_parse(str(d), fuzzy=True)
-            except Exception: dt = None
-        if dt is None and arr_col:
-            a = ws.cell(row=r, column=arr_col).value
-            if isinstance(a, datetime): dt = a
-            elif a not in (None, ""):
-                try: dt = du_parse(str(a), fuzzy=True)
-                except Exception: dt = None
-        
-        if dt:
-            period = monyy(dt.year, dt.month)
-            if earliest_dep is None or dt < earliest_dep: earliest_dep = dt
-        else:
-            period = "Unknown"
-        
-        k = norm_key(ws.cell(row=r, column=res_col).value)
-        if k:
-            keys_by_period.setdefault(period, set()).add(k)
-            rows_by_period.setdefault(period, []).append(r)
-
-    format_dates(ws, [arr_col, dep_col], data_start, data_end)
-    return {"res_col": res_col, "rows_by_period": rows_by_period, "keys_by_period": keys_by_period,
+    # Whole-column passes: keys, departure dates (arrival as fallback), then group rows by period
+    body = rows[data_start-1:data_end]
+    parsed = {}
+    dts = parse_dates([row[dep_col-1] for row in body], parsed) if dep_col else [None] * len(body)
+    if arr_col:
+        arr = parse_dates([row[arr_col-1] if d is None else None for row, d in zip(body, dts)], parsed)
+        dts = [d or a for d, a in zip(dts, arr)]
+    earliest_dep = min((d for d in dts if d is not None), default=None)
+
+    # The fallback column 2 may not exist on a narrow sheet: then no row has a key
+    width = len(rows[1]) if len(rows) > 1 else 0
+    df = pd.DataFrame({
+        "key": norm_keys([row[res_col-1] for row in body]) if res_col <= width else [""] * len(body),
+        "period": [f"{MONTH_ABBR[d.month]}'{d.year % 100:02d}" if d else "Unknown" for d in dts], # monyy, inlined
+    }, index=pd.RangeIndex(data_start, data_end+1))
+    df = df[df["key"] != ""]
+    rows_by_period = {p: idx.tolist() for p, idx in df.groupby("period", sort=False).groups.items()}
+    key_by_row = df["key"].to_dict()
+
+    return {"res_col": res_col, "rows_by_period": rows_by_period, "key_by_row": key_by_row,
             "earliest_dep": earliest_dep, "arr_col": arr_col, "dep_col": dep_col, "ota_col": ota_col}
 
 # --- CORE LOGIC: OTA Excel Processing ---
 
-def detect_commission_settings(ws):
+def detect_commission_settings(rows):
     # Auto-detect headers logic from v1.15
     keywords = ["reservation", "booking id"]
     best_row, best_col = 1, 2
     
     # Simple scan first 10 rows
-    for r in range(1, min(11, ws.max_row+1)):
-        for c in range(1, ws.max_column+1):
-            v = str(ws.cell(row=r, column=c).value or "").lower()
+    for r, row in enumerate(rows[:10], start=1):
+        for c, v in enumerate(row, start=1):
+            v = str(v or "").lower()
             if any(k in v for k in keywords):
                 best_row = r
                 best_col = c
@@ -174,65 +275,88 @@ def detect_commission_settings(ws):
         
     return {"header_row": best_row, "reservation_col_idx": best_col, "data_start_row": best_row + 1}
 
-def collect_commission_excel(ws, settings):
+def collect_commission_excel(rows, settings):
     col_idx = settings["reservation_col_idx"]
     data_start = settings["data_start_row"]
-    keys = set()
     earliest = None
     
     # Try to find date column for earliest date detection
     hdr = settings["header_row"]
+    header = rows[hdr-1] if len(rows) >= hdr else []
     date_col = None
-    for c in range(1, ws.max_column+1):
-        v = str(ws.cell(row=hdr, column=c).value or "").lower()
+    for c, v in enumerate(header, start=1):
+        v = str(v or "").lower()
         if "arrival" in v or "check-in" in v or "departure" in v:
             date_col = c
             break
-            
-    for r in range(data_start, ws.max_row+1):
-        k = norm_key(ws.cell(row=r, column=col_idx).value)
-        if k: keys.add(k)
-        if date_col:
-            val = ws.cell(row=r, column=date_col).value
-            dt = val if isinstance(val, datetime) else None
-            if not dt and val:
-                try: dt = du_parse(str(val), fuzzy=True)
-                except: pass
-            if dt and (earliest is None or dt < earliest): earliest = dt
+
+    body = rows[data_start-1:]
+    width = len(header)
+    keys = set(norm_keys([row[col_idx-1] for row in body] if col_idx <= width else []))
+    keys.discard("")
+
+    if date_col:
+        dts = parse_dates([row[date_col-1] or None for row in body], {})
+        earliest = min((d for d in dts if d is not None), default=None)
             
     return keys, earliest
 
 # --- CORE LOGIC: Expedia PDF Parser (HUNTER MODE V2) ---
-# Replaces the old parse_expedia_pdf_to_ws but outputs to an Excel sheet structure
-def parse_expedia_hunter_to_ws(pdf_stream, out_wb, sheet_name):
-    ws = out_wb.create_sheet(sheet_name)
+
+# PDFium is not thread-safe, even across separate documents, and OTA jobs run on a thread pool:
+# native PDF work is serialized. Taken inside the cached function, so cache hits skip it.
+_PDF_LOCK = threading.Lock()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def extract_pdf_text(pdf_bytes):
+    # Hunter only needs the flattened text, so read it with PDFium's C extractor (pypdfium2)
+    # rather than pdfminer's pure-Python layout analysis.
+    # Cached on the PDF bytes: re-running the same statement skips parsing. Memory only, and bounded,
+    # since the text holds guest and reservation data (never written to disk, gone on restart).
+    # Imported here, not at module top, so sessions without PDFs never pay for it.
+    with _PDF_LOCK:
+        import pypdfium2 as pdfium
+        parts = []
+        pdf = pdfium.PdfDocument(pdf_bytes)
+        try:
+            for page in pdf:
+                textpage = page.get_textpage()
+                parts.append(textpage.get_text_range() + "\n")
+                textpage.close(); page.close()  # free PDFium's page objects before the next one
+        finally:
+            pdf.close()
+        return "".join(parts)
+
+# Replaces the old parse_expedia_pdf_to_ws but outputs rows in the OTA sheet structure (header first)
+def parse_expedia_hunter(pdf_bytes):
     headers = ["Booking Type","Reservation ID","Check-In Date","Nights","Guest Name","Currency","Amount Before Tax","Tax","Total Amount Due"]
-    ws.append(headers)
     
     keys = set()
     earliest = None
+    rows = [headers]
     
-    with pdfplumber.open(pdf_stream) as pdf:
-        full_text = ""
-        for page in pdf.pages:
-            full_text += (page.extract_text() or "") + "\n"
+    full_text = extract_pdf_text(pdf_bytes) # cached on the bytes: reruns skip PDF parsing
             
     # Cleaning
-    cleaned = full_text.replace('\n', ' ').replace('"', ' ').replace(',', '')
-    cleaned = re.sub(r'\s+', ' ', cleaned)
+    cleaned = full_text.translate(_CLEAN_TABLE)
+    cleaned = _WS_RE.sub(' ', cleaned)
     
     # Hunter Regex
-    matches = re.finditer(r'(Expedia Collect|Hotel Collect)\s.*?(\d{8,15})\s.*?(\d{1,2}-[A-Za-z]{3}-\d{4})', cleaned, re.IGNORECASE)
-    
-    for m in matches:
-        bt = m.group(1)
-        rid = m.group(2)
-        dt_txt = m.group(3)
+    last_end = 0
+    for a in _HUNTER_ANCHOR_RE.finditer(cleaned):
+        if a.start() < last_end: continue # inside the previous booking's match
+        m = _HUNTER_ID_DATE_RE.search(cleaned, a.end(), a.end() + HUNTER_WINDOW)
+        if not m: continue
+        last_end = m.end()
+        
+        bt = a.group(1)
+        rid = m.group(1)
+        dt_txt = m.group(2)
         
         # Determine Amounts
         end_pos = m.end()
         window = cleaned[end_pos:end_pos+150]
-        prices = re.findall(r'(\d+\.\d{2})', window)
+        prices = _PRICE_RE.findall(window)
         
         amt, tax, tot = "0.00", "0.00", "0.00"
         if prices:
@@ -240,8 +364,8 @@ def parse_expedia_hunter_to_ws(pdf_stream, out_wb, sheet_name):
             if len(prices) >= 2: amt = prices[-2]
             else: amt = tot
             
-        try: dt = du_parse(dt_txt)
-        except: dt = None
+        try: dt = datetime.strptime(dt_txt, "%d-%b-%Y") # shape fixed by _HUNTER_ID_DATE_RE
+        except ValueError: dt = None
         
         if dt:
             if earliest is None or dt < earliest: earliest = dt
@@ -251,59 +375,50 @@ def parse_expedia_hunter_to_ws(pdf_stream, out_wb, sheet_name):
         # Guest Name (Placeholder)
         guest = "Guest"
         
-        ws.append([bt, rid, dt, "1", guest, "THB", amt, tax, tot])
-    
-    # Format Date Col
-    for r in range(2, ws.max_row+1):
-        ws.cell(row=r, column=3).number_format = "yyyy-mm-dd"
+        rows.append([bt, rid, dt, "1", guest, "THB", amt, tax, tot])
         
-    return ws, 2, 2, earliest, keys
+    return rows, earliest, keys
 
 # --- MAIN RECONCILIATION PROCESS ---
 
-def process_reconciliation(hot_file, ota_file):
-    # Setup Output Workbook
-    out_wb = Workbook()
-    out_wb.remove(out_wb.active) # Remove default sheet
+def load_hoteliers(hot_name, hot_bytes):
+    # Read + scan a Hoteliers export once; every OTA file matched to it reuses the result (read-only)
+    hot_rows = read_sheet_rows(hot_bytes)
+    return {"name": hot_name, "rows": hot_rows, "info": collect_hoteliers(hot_rows)}
+
+def process_reconciliation(hot, ota_file):
+    # Setup Output Workbook (write-only: every sheet is streamed once, styles set at write time)
+    out_wb = Workbook(write_only=True)
     
-    # 1. Load Hoteliers
-    hot_wb = load_workbook(hot_file, data_only=True)
-    hot_ws_src = hot_wb.active
-    hot_info = collect_hoteliers(hot_ws_src) # Scan for periods/keys
+    # 1. Hoteliers (loaded and scanned by load_hoteliers)
+    hot_rows = hot["rows"]
+    hot_info = hot["info"]
     
     # 2. Load/Parse OTA
     ota_filename = ota_file.name
     ota_name = os.path.splitext(ota_filename)[0]
     is_pdf_file = ota_filename.lower().endswith('.pdf')
     
+    # OTA rows are written to this sheet after matching, with highlights applied as they are written
+    com_ws = out_wb.create_sheet(trim_sheet(ota_name))
     if is_pdf_file:
         # Use Hunter Parser
-        com_ws, res_col_idx, data_start, com_earliest, com_keys = parse_expedia_hunter_to_ws(
-            ota_file, out_wb, trim_sheet(ota_name))
-        com_settings = {"header_row": 1, "reservation_col_idx": res_col_idx, "data_start_row": data_start}
+        ota_rows, com_earliest, com_keys = parse_expedia_hunter(ota_file.getvalue())
+        com_settings = {"header_row": 1, "reservation_col_idx": 2, "data_start_row": 2}
     else:
         # Excel OTA
-        com_wb = load_workbook(ota_file, data_only=True)
-        com_ws_src = com_wb.active
-        com_ws = out_wb.create_sheet(trim_sheet(ota_name))
-        for r in com_ws_src.iter_rows(values_only=True):
-            com_ws.append(r)
-            
-        com_settings = detect_commission_settings(com_ws)
-        com_keys, com_earliest = collect_commission_excel(com_ws, com_settings)
+        ota_rows = read_sheet_rows(ota_file.getvalue())
+        com_settings = detect_commission_settings(ota_rows)
+        com_keys, com_earliest = collect_commission_excel(ota_rows, com_settings)
 
     # 3. Determine Period & Target OTA
-    hot_filename = hot_file.name
+    hot_filename = hot["name"]
     target_period = choose_period(hot_filename, ota_filename, hot_info["earliest_dep"], com_earliest)
     target_ota_type = infer_ota(ota_filename)
     
     # 4. Build "Hoteliers" Sheet (Filtered by Period & OTA)
     hot_sheet_name = trim_sheet(os.path.splitext(hot_filename)[0])
     hot_ws_out = out_wb.create_sheet(hot_sheet_name, 0) # Put first
-    
-    # Copy Headers
-    for r in range(1, 3):
-        hot_ws_out.append([c.value for c in hot_ws_src[r]])
         
     # Filter Rows
     hot_rows_period = hot_info["rows_by_period"].get(target_period, [])
@@ -311,17 +426,21 @@ def process_reconciliation(hot_file, ota_file):
     ota_col = hot_info["ota_col"]
     
     if ota_col:
+        match_all = not target_ota_type or target_ota_type == "OTA"
+        target_canon = canon_ota(target_ota_type)
+        matches = {} # channel text -> match; the OTA column holds only a handful of distinct values
         for r_idx in hot_rows_period:
-            val = hot_ws_src.cell(row=r_idx, column=ota_col).value
+            val = str(hot_rows[r_idx-1][ota_col-1])
             # Match OTA Logic (v1.15)
             # If target is Expedia, we match "Expedia", "Hotels.com"
             # If target is Booking, match "Booking.com"
-            if not target_ota_type or target_ota_type == "OTA": 
+            if match_all: 
                 is_match = True
             else:
-                cell_canon = canon_ota(str(val))
-                target_canon = canon_ota(target_ota_type)
-                is_match = (target_canon == cell_canon) or (target_canon in cell_canon)
+                is_match = matches.get(val)
+                if is_match is None:
+                    cell_canon = canon_ota(val)
+                    is_match = matches[val] = (target_canon == cell_canon) or (target_canon in cell_canon)
             
             if is_match:
                 included_rows.append(r_idx)
@@ -332,58 +451,40 @@ def process_reconciliation(hot_file, ota_file):
     else:
         included_rows = hot_rows_period
 
-    # Copy Included Rows
-    hot_out_keys = set()
-    hot_res_col = hot_info["res_col"]
-    
-    for r_idx in included_rows:
-        row_vals = [c.value for c in hot_ws_src[r_idx]]
-        hot_ws_out.append(row_vals)
-        # Record key
-        k = norm_key(hot_ws_src.cell(row=r_idx, column=hot_res_col).value)
-        if k: hot_out_keys.add(k)
-        
-    # Format Dates in Output
-    for c in [hot_info["arr_col"], hot_info["dep_col"]]:
-        if c: format_dates(hot_ws_out, [c], 3, hot_ws_out.max_row)
+    key_by_row = hot_info["key_by_row"]
+    hot_out_keys = {key_by_row[r_idx] for r_idx in included_rows}
 
     # 5. Calculate Differences
     only_hot = hot_out_keys - com_keys
     only_com = com_keys - hot_out_keys
     
+    # Normalized key per OTA row, shared by the amount check and the highlight pass
+    c_col = com_settings["reservation_col_idx"]
+    start = com_settings["data_start_row"]
+    ota_keys = norm_keys([row[c_col-1] if c_col <= len(row) else None for row in ota_rows])
+    
     # --- Booking.com Special Logic: Check Amount == 0 ---
     if "booking" in ota_filename.lower() and not is_pdf_file:
         # Locate Final & Commission columns in OTA sheet
         hdr_row = com_settings["header_row"]
         final_col = None
         comm_col = None
-        for c in range(1, com_ws.max_column+1):
-            v = str(com_ws.cell(row=hdr_row, column=c).value or "").lower()
+        header = ota_rows[hdr_row-1] if len(ota_rows) >= hdr_row else []
+        for c, v in enumerate(header, start=1):
+            v = str(v or "").lower()
             if "final" in v and "amount" in v: final_col = c
             if "commission" in v and "amount" in v: comm_col = c
             
         real_only_com = set()
-        for k in only_com:
-            # Find the row for this key to check amount
-            # This is slow O(N^2) but safe. Optimization: Build map first if needed.
-            # For simplicity in this structure:
-            row_to_check = None
-            col_idx = com_settings["reservation_col_idx"]
-            for r in range(com_settings["data_start_row"], com_ws.max_row+1):
-                if norm_key(com_ws.cell(row=r, column=col_idx).value) == k:
-                    row_to_check = r
-                    break
-            
-            if row_to_check:
-                f_val = 0
-                c_val = 0
-                try: f_val = float(com_ws.cell(row=row_to_check, column=final_col).value or 0)
-                except: pass
-                try: c_val = float(com_ws.cell(row=row_to_check, column=comm_col).value or 0)
-                except: pass
-                
-                if f_val != 0 and c_val != 0:
-                    real_only_com.add(k)
+        if final_col and comm_col:
+            # Whole-column check: a key counts if the first row carrying it has both amounts non-zero
+            # (non-numeric amounts count as 0)
+            ota_df = pd.DataFrame(ota_rows[start-1:], dtype=object)
+            if len(ota_df):
+                row_keys = pd.Series(ota_keys[start-1:], index=ota_df.index)
+                amounts = ota_df[[final_col-1, comm_col-1]].apply(pd.to_numeric, errors="coerce").fillna(0)
+                billable = ~row_keys.duplicated() & (amounts != 0).all(axis=1)
+                real_only_com = only_com.intersection(row_keys[billable])
         
         # Update set
         only_com = real_only_com
@@ -396,38 +497,37 @@ def process_reconciliation(hot_file, ota_file):
         # So `only_hot = hot - com_keys` is correct (if key exists in OTA, hot is fine).
         # The logic only applies to `only_com` (Extra in OTA) - we don't want to highlight 0-amount cancellations.
 
-    # 6. Apply Highlights
-    # Hoteliers Sheet
-    for r in range(3, hot_ws_out.max_row+1):
-        k = norm_key(hot_ws_out.cell(row=r, column=hot_res_col).value)
-        if k in only_hot: # Missing in OTA
-            for c in range(1, hot_ws_out.max_column+1): hot_ws_out.cell(row=r, column=c).fill = RED_FILL
-        elif k in only_com: # (Shouldn't happen in Hoteliers sheet logic usually, but consistent with v1.15)
-            pass 
-
-    # OTA Sheet
-    c_col = com_settings["reservation_col_idx"]
-    start = com_settings["data_start_row"]
-    for r in range(start, com_ws.max_row+1):
-        k = norm_key(com_ws.cell(row=r, column=c_col).value)
-        if k in only_com: # Missing in Hoteliers (and passed amount check)
-             for c in range(1, com_ws.max_column+1): com_ws.cell(row=r, column=c).fill = RED_FILL
+    # 6. Write Sheets with Highlights
+    # Hoteliers Sheet: headers, then included rows (red when missing in OTA, dates formatted)
+    for row in hot_rows[:2]:
+        hot_ws_out.append(row)
+    hot_date_cols = {c for c in (hot_info["arr_col"], hot_info["dep_col"]) if c}
+    for r_idx in included_rows:
+        fill = RED_FILL if key_by_row[r_idx] in only_hot else None # Missing in OTA
+        hot_ws_out.append(styled_row(hot_ws_out, hot_rows[r_idx-1], fill, hot_date_cols))
+
+    # OTA Sheet: single copy pass, red rows built already filled
+    com_date_cols = {3} if is_pdf_file else () # Hunter "Check-In Date"
+    for r, (row, k) in enumerate(zip(ota_rows, ota_keys), start=1):
+        if r >= start and k in only_com: # Missing in Hoteliers (and passed amount check)
+            com_ws.append(styled_row(com_ws, row, RED_FILL, com_date_cols))
+        elif r >= start and com_date_cols:
+            com_ws.append(styled_row(com_ws, row, date_cols=com_date_cols))
+        else:
+            com_ws.append(row)
 
     # 7. Create NotMatched Sheet
+    # Column A: Hoteliers only, column C: Commission only (written side by side, row by row)
     nm = out_wb.create_sheet("NotMatched")
-    nm["A1"].value = f"Hoteliers only ({len(only_hot)})"; nm["A1"].font = Font(bold=True); nm["A1"].fill = GREEN_FILL
-    nm["C1"].value = f"Commission only ({len(only_com)})"; nm["C1"].font = Font(bold=True); nm["C1"].fill = RED_FILL
-    nm["A2"].value = "Reservation Number"; nm["A2"].font = Font(bold=True)
-    nm["C2"].value = "Reservation Number"; nm["C2"].font = Font(bold=True)
+    bold = Font(bold=True)
+    nm.append([styled_cell(nm, f"Hoteliers only ({len(only_hot)})", GREEN_FILL, bold), None,
+               styled_cell(nm, f"Commission only ({len(only_com)})", RED_FILL, bold)])
+    nm.append([styled_cell(nm, "Reservation Number", font=bold), None,
+               styled_cell(nm, "Reservation Number", font=bold)])
     
-    r = 3
-    for k in sorted(only_hot):
-        nm.cell(row=r, column=1, value=str(k)).fill = GREEN_FILL
-        r += 1
-    r = 3
-    for k in sorted(only_com):
-        nm.cell(row=r, column=3, value=str(k)).fill = RED_FILL
-        r += 1
+    for k_hot, k_com in zip_longest(sorted(only_hot), sorted(only_com)):
+        nm.append([styled_cell(nm, str(k_hot), GREEN_FILL) if k_hot is not None else None, None,
+                   styled_cell(nm, str(k_com), RED_FILL) if k_com is not None else None])
 
     # 8. Create Tools Sheet
     tools = out_wb.create_sheet("Commission_Tools")
@@ -439,6 +539,20 @@ def process_reconciliation(hot_file, ota_file):
     
     return out_wb, target_period, len(only_hot), len(only_com)
 
+def reconcile_one(hot_job, ota_name, ota_bytes):
+    # Worker for the OTA thread pool: bytes in, bytes out (no st.* calls off the main thread).
+    # hot_job is the shared load_hoteliers future for the matched Hoteliers file.
+    hot = hot_job.result()
+    ota_stream = BytesIO(ota_bytes)
+    ota_stream.name = ota_name
+    
+    wb_result, period, n_hot, n_ota = process_reconciliation(hot, ota_stream)
+    
+    # Save to buffer
+    out_io = BytesIO()
+    wb_result.save(out_io)
+    return out_io.getvalue(), period, n_hot, n_ota
+
 # --- WEB UI ---
 
 st.title("🏨 Hotel Reconcile Pro (Web Version)")
@@ -467,11 +581,13 @@ if st.button("🚀 Process Reconcile", type="primary"):
         
         # Prepare Hoteliers list
         # We need to keep them readable multiple times, so read to bytes
+        # Hotel code and period are classified once per file, not once per OTA file
         hot_buffers = []
         for hf in hot_files:
-            hot_buffers.append({"name": hf.name, "bytes": hf.getvalue()})
+            hot_buffers.append({"name": hf.name, "bytes": hf.getvalue(),
+                                "hotel": infer_hotel(hf.name), "period": extract_period_from_name(hf.name)})
             
-        results_zip = []
+        jobs = []
         
         for of in ota_files:
             ota_name = of.name
@@ -485,37 +601,43 @@ if st.button("🚀 Process Reconcile", type="primary"):
             best_hot = None
             
             # Simple matching strategy: Match Hotel Code first
-            candidates = [h for h in hot_buffers if infer_hotel(h["name"]) == ota_hotel]
+            candidates = [h for h in hot_buffers if h["hotel"] == ota_hotel]
             if not candidates: candidates = hot_buffers # Fallback to all
             
             # If period found in OTA name, try to find in Hoteliers name
+            # (compared as parsed periods, so "Jan'25" also matches "January 2025" or "2025-01")
             if ota_period:
-                period_matches = [h for h in candidates if ota_period.lower() in h["name"].lower()]
+                period_matches = [h for h in candidates if h["period"] == ota_period]
                 if period_matches: best_hot = period_matches[0]
             
             if not best_hot and candidates: best_hot = candidates[0]
             
-            if best_hot:
-                # Wrap in BytesIO for processing
-                hot_stream = BytesIO(best_hot["bytes"])
-                hot_stream.name = best_hot["name"]
-                
-                ota_stream = of # Streamlit uploader is already a stream-like
+            jobs.append((of, ota_hotel, best_hot))
+        
+        # Each OTA file is independent: reconcile them concurrently, report in upload order.
+        # Workers get this run's context so the st.cache_data helpers work inside them.
+        with ThreadPoolExecutor(initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as ex:
+            # Load each matched Hoteliers file once. These are queued ahead of every OTA job,
+            # so a job waiting on its Hoteliers future never blocks a load from starting.
+            for _, _, best_hot in jobs:
+                if best_hot and "job" not in best_hot:
+                    best_hot["job"] = ex.submit(load_hoteliers, best_hot["name"], best_hot["bytes"])
+            futures = [ex.submit(reconcile_one, best_hot["job"], of.name, of.getvalue()) if best_hot else None
+                       for of, _, best_hot in jobs]
+            
+            for (of, ota_hotel, _), fut in zip(jobs, futures):
+                ota_name = of.name
+                if fut is None:
+                    st.warning(f"Could not find matching Hoteliers file for {ota_name}")
+                    continue
                 
                 try:
-                    wb_result, period, n_hot, n_ota = process_reconciliation(hot_stream, ota_stream)
-                    
-                    # Save to buffer
-                    out_io = BytesIO()
-                    wb_result.save(out_io)
-                    out_io.seek(0)
+                    out_bytes, period, n_hot, n_ota = fut.result()
                     
                     out_name = f"Reconcile-{ota_hotel}-{ota_name[:10]}-{period}.xlsx"
                     
                     st.success(f"✅ {out_name} | Miss Hot: {n_hot} | Miss OTA: {n_ota}")
-                    st.download_button(label=f"📥 Download {out_name}", data=out_io, file_name=out_name, mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+                    st.download_button(label=f"📥 Download {out_name}", data=out_bytes, file_name=out_name, mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
                     
                 except Exception as e:
                     st.error(f"Error processing {ota_name}: {e}")
-            else:
-                st.warning(f"Could not find matching Hoteliers file for {ota_name}")